@@ -1,19 +1,29 @@
 """
 This is a proof of concept script that fetches listings from Facebook Marketplace for a given city and search query.
-It uses Playwright to automate the browser and fetch the listings, and BeautifulSoup to parse the HTML content of each listing.
+It uses Playwright to automate the browser and fetch the listings, extracting the fields of each listing directly from the page.
 
 The end goal is to automatically parse listings into specified data classes and save them to a DB.
 """
 
+import asyncio
 import logging
 import json
 import os
-from typing import List, Optional, Tuple
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 
-from bs4 import BeautifulSoup
+import orjson
 from dotenv import load_dotenv
-from playwright.sync_api import sync_playwright, Browser, Page
-from block import blocking_intercept
+from playwright.async_api import (
+    async_playwright,
+    Browser,
+    BrowserContext,
+    Page,
+    Error as PlaywrightError,
+    TimeoutError as PlaywrightTimeoutError,
+)
+from block import BLOCK_LAUNCH_ARGS, enable_request_blocking
 
 from dataclasses import dataclass
 from exceptions import CredentialsError, ParseError
@@ -28,20 +38,58 @@ logger.addHandler(handler)
 
 # Load environment variables from .env file
 load_dotenv()
-email = os.getenv("FB_EMAIL")
-password = os.getenv("FB_PASSWORD")
+EMAIL: str = os.environ.get("FB_EMAIL", "")
+PASSWORD: str = os.environ.get("FB_PASSWORD", "")
 
-if not email or not password:
+if not EMAIL or not PASSWORD:
     raise CredentialsError(
         "Facebook email and password must be set as environment variables."
     )
 logger.info("Environment variables loaded successfully.")
 
 
-LOGIN_URL = "https://www.facebook.com/login/device-based/regular/login/"
+FACEBOOK_URL = "https://www.facebook.com"
+LOGIN_URL = f"{FACEBOOK_URL}/login/device-based/regular/login/"
+MARKETPLACE_URL = f"{FACEBOOK_URL}/marketplace/"
 
+# Login form selectors
+EMAIL_SELECTOR = "input[name='email']"
+PASSWORD_SELECTOR = "input[name='pass']"
+LOGIN_BUTTON_SELECTOR = "button[name='login']"
 
-@dataclass
+# Cookies and local storage saved after logging in, reused to skip the login on later runs
+STORAGE_STATE_PATH = "fb_state.json"
+
+# Runs of anything but decimal digits, in any script
+NON_DIGIT_PATTERN = re.compile(r"\D+")
+
+# Number of listing pages navigated at the same time when fetching descriptions
+DESCRIPTION_CONCURRENCY = 4
+
+# Listing page selectors
+LISTINGS_SELECTOR = "div.x8gbvx8 > div"
+DESCRIPTION_SELECTOR = "div.xz9dl7a.x4uap5.xsag5q8.xkhd6sd.x126k92a"
+
+# Listing card selectors
+IMAGE_SELECTOR = "img.xt7dq6l.xl1xv1r.x6ikm8r.x10wlt62.xh8yej3"
+TITLE_SELECTOR = "span.x1lliihq.x6ikm8r.x10wlt62.x1n2onr6"
+PRICE_SELECTOR = "span.x193iq5w"
+URL_SELECTOR = "a.x1i10hfl"
+LOCATION_SELECTOR = "span.x1lliihq.x6ikm8r.x10wlt62.x1n2onr6.xlyipyv.xuxw1ft"
+
+# Reads every field of the first `limit` listing cards in one round trip to the browser
+EXTRACT_LISTINGS_SCRIPT = f"""(cards, limit) => cards.slice(0, limit || cards.length).map(
+    card => ({{
+        image: card.querySelector({json.dumps(IMAGE_SELECTOR)})?.getAttribute("src"),
+        title: card.querySelector({json.dumps(TITLE_SELECTOR)})?.textContent,
+        price: card.querySelector({json.dumps(PRICE_SELECTOR)})?.textContent,
+        url: card.querySelector({json.dumps(URL_SELECTOR)})?.getAttribute("href"),
+        location: card.querySelector({json.dumps(LOCATION_SELECTOR)})?.textContent,
+    }})
+)"""
+
+
+@dataclass(slots=True)
 class Listing:
     """
     Data class representing a Facebook Marketplace listing.
@@ -62,12 +110,14 @@ class Listing:
         )
 
 
-def open_browser(pw, headless: bool = True) -> Tuple[Page, Browser]:
+async def open_browser(pw, headless: bool = True) -> Tuple[Page, Browser]:
     """
     Opens a browser and returns the Playwright page object.
 
+    A saved login session is loaded into the context if one exists.
+
     Args:
-        pw (SyncPlaywright): The Playwright instance.
+        pw (Playwright): The Playwright instance.
         headless (bool): Whether to launch the browser in headless mode.
 
     Returns:
@@ -75,70 +125,138 @@ def open_browser(pw, headless: bool = True) -> Tuple[Page, Browser]:
 
 
     """
-    browser = pw.firefox.launch(headless=headless)
-    context = browser.new_context(geolocation=None, permissions=["geolocation"])
-    page = context.new_page()
-    page.route("**/*", blocking_intercept)
+    browser = await pw.chromium.launch(
+        headless=headless,
+        # Hide navigator.webdriver so pages are served as to a regular browser
+        args=[*BLOCK_LAUNCH_ARGS, "--disable-blink-features=AutomationControlled"],
+    )
+    storage_state = STORAGE_STATE_PATH if os.path.exists(STORAGE_STATE_PATH) else None
+    context = await browser.new_context(
+        geolocation=None, permissions=["geolocation"], storage_state=storage_state
+    )
+    page = await new_page(context)
     logger.info("Browser opened successfully.")
     return page, browser
 
 
-def login_to_facebook(page: Page) -> None:
+async def new_page(context: BrowserContext) -> Page:
+    """
+    Opens a new page in the context with request blocking enabled.
+
+    Args:
+        context (BrowserContext): The browser context in which to open the page.
+
+    Returns:
+        Page: The Playwright page object.
+    """
+    page = await context.new_page()
+    await enable_request_blocking(page)
+    return page
+
+
+async def login_to_facebook(page: Page) -> None:
     """
     Log into Facebook using the provided credentials.
 
     Args:
         page (Page): The Playwright page object.
     """
-    EMAIL_SELECTOR = "input[name='email']"
-    PASSWORD_SELECTOR = "input[name='pass']"
-    LOGIN_BUTTON_SELECTOR = "button[name='login']"
-
     logger.info("Logging in to Facebook at %s.", LOGIN_URL)
-    page.goto(LOGIN_URL, wait_until="domcontentloaded")
-    page.fill(EMAIL_SELECTOR, email)
-    page.fill(PASSWORD_SELECTOR, password)
-    page.click(LOGIN_BUTTON_SELECTOR)
+    await page.goto(LOGIN_URL, wait_until="domcontentloaded")
+    await page.fill(EMAIL_SELECTOR, EMAIL)
+    await page.fill(PASSWORD_SELECTOR, PASSWORD)
+    async with page.expect_navigation(wait_until="domcontentloaded"):
+        await page.click(LOGIN_BUTTON_SELECTOR)
     logger.info("Logged in successfully.")
 
 
-def get_descriptions(listings: List[Listing]) -> None:
+async def login_if_needed(page: Page) -> None:
+    """
+    Log into Facebook unless the browser context holds a live session, then save the session.
+
+    A saved session is checked by opening Marketplace, it has expired if Facebook redirects to the
+    login page or shows the login form.
+
+    Args:
+        page (Page): The Playwright page object.
+    """
+    # Facebook sets the c_user cookie only for logged in sessions
+    cookies = await page.context.cookies(FACEBOOK_URL)
+    if any(cookie["name"] == "c_user" for cookie in cookies):
+        await page.goto(MARKETPLACE_URL, wait_until="domcontentloaded")
+        if "/login" not in page.url and not await page.locator(EMAIL_SELECTOR).count():
+            logger.info("Reusing saved Facebook session from %s.", STORAGE_STATE_PATH)
+            return
+        logger.info("Saved Facebook session has expired.")
+
+    await login_to_facebook(page)
+    await page.context.storage_state(path=STORAGE_STATE_PATH)
+    logger.info("Saved Facebook session to %s.", STORAGE_STATE_PATH)
+
+
+async def get_descriptions(
+    page: Page, listings: List[Listing], concurrency: int = DESCRIPTION_CONCURRENCY
+) -> None:
     """
     Fetches the descriptions for a list of listings.
 
+    Listings are fetched concurrently on a bounded pool of pages sharing the logged in browser
+    context. A listing whose description cannot be loaded keeps a description of None.
+
     Args:
+        page (Page): The Playwright page object, already logged in.
         listings (List[Listing]): The listings for which to fetch descriptions.
+        concurrency (int): The maximum number of listings to fetch at the same time.
     """
-    DESCRIPTION_SELECTOR = "div.xz9dl7a.x4uap5.xsag5q8.xkhd6sd.x126k92a"
-
     logger.info("Fetching descriptions for %s listings.", len(listings))
-    with sync_playwright() as pw:
-        # Open browser
-        page, browser = open_browser(pw)
-
-        # Login process
-        login_to_facebook(page)
 
-        for listing in listings:
+    # Pool of pages, a listing waits here until a page is free
+    pages: asyncio.Queue[Page] = asyncio.Queue()
+    pages.put_nowait(page)
+    extra_pages = [
+        await new_page(page.context) for _ in range(min(concurrency, len(listings)) - 1)
+    ]
+    for extra_page in extra_pages:
+        pages.put_nowait(extra_page)
+    logger.info("Opened %s pages.", pages.qsize())
+
+    async def fetch_description(listing: Listing) -> None:
+        listing_page = await pages.get()
+        try:
             # Navigate to listing
             logger.info("Fetching description for listing %s.", listing.title)
             logger.info("Navigating to listing at %s.", listing.post_url)
-            page.goto(listing.post_url, wait_until="domcontentloaded")
+            # inner_text below waits for the description itself
+            await listing_page.goto(listing.post_url, wait_until="commit")
             logger.info("Navigated to listing successfully.")
 
             # Extract description
-            description = page.locator(DESCRIPTION_SELECTOR).inner_text()
+            description = await listing_page.locator(DESCRIPTION_SELECTOR).inner_text()
             logger.debug("Description: %s", description)
-
+        except PlaywrightError as e:
+            logger.warning(
+                "Failed to fetch description for listing %s: %s", listing.post_url, e.message
+            )
+        else:
             # Update the description
             listing.description = description
             logger.info("Description fetched successfully.")
-
-        # Close the browser
-        browser.close()
-        logger.info("Browser closed successfully.")
-
-
+        finally:
+            pages.put_nowait(listing_page)
+
+    tasks = [asyncio.create_task(fetch_description(listing)) for listing in listings]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # Stop any task still using a page before closing the pages
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for extra_page in extra_pages:
+            await extra_page.close()
+
+
+@lru_cache(maxsize=4096)
 def clean_listing_url(url: str) -> str:
     """
     Cleans a Facebook Marketplace listing URL to remove tracking parameters and add the base URL.
@@ -149,7 +267,7 @@ def clean_listing_url(url: str) -> str:
     Returns:
         str: The cleaned URL.
     """
-    return f"https://www.facebook.com{url.split('?', 1)[0]}"
+    return FACEBOOK_URL + url.partition("?")[0]
 
 
 def convert_price_to_int(price: str) -> int:
@@ -163,9 +281,14 @@ def convert_price_to_int(price: str) -> int:
 
     Returns:
         int: The price as an integer.
+
+    Raises:
+        ParseError: If the price contains no digits.
     """
-    price = "".join(filter(str.isdigit, price))
-    return int(price)
+    digits = NON_DIGIT_PATTERN.sub("", price)
+    if not digits:
+        raise ParseError(f"No digits in price {price!r}.")
+    return int(digits)
 
 
 def create_marketplace_url(
@@ -188,7 +311,7 @@ def create_marketplace_url(
     Returns:
         str: The generated Facebook Marketplace URL.
     """
-    url = f"https://www.facebook.com/marketplace/{city}/search?query={query}"
+    url = f"{FACEBOOK_URL}/marketplace/{city}/search?query={query}"
     if max_price is not None:
         url += f"&maxPrice={max_price}"
     if min_price is not None:
@@ -198,7 +321,8 @@ def create_marketplace_url(
     return url
 
 
-def fetch_marketplace_listings(
+async def fetch_marketplace_listings(
+    page: Page,
     city: str,
     query: str,
     max_price: Optional[int] = None,
@@ -209,6 +333,7 @@ def fetch_marketplace_listings(
     Fetches listings from Facebook Marketplace based on provided search criteria.
 
     Args:
+        page (Page): The Playwright page object, already logged in.
         city (str): The city in which to search for listings.
         query (str): The search query or item type to look for.
         max_price (int): The maximum price of the items to fetch.
@@ -218,9 +343,6 @@ def fetch_marketplace_listings(
     Returns:
         List[Listing]: A list of Listing objects representing the fetched listings.
     """
-    PAGE_OPEN_SELECTOR = 'text="Marketplace"'
-    LISTINGS_SELECTOR = "div.x8gbvx8 > div"
-
     logger.info(
         "Fetching Facebook Marketplace listings for %s in %s with max price %s and min price %s.",
         query,
@@ -232,55 +354,86 @@ def fetch_marketplace_listings(
     # URLs setup
     marketplace_url = create_marketplace_url(city, query, max_price, min_price)
 
-    # Launch browser and fetch listings
-    logger.info("Launching browser and fetching listings.")
-    with sync_playwright() as pw:
+    # Navigate to marketplace
+    logger.info("Navigating to marketplace at %s.", marketplace_url)
+    await page.goto(marketplace_url, wait_until="commit")
+    # Wait for a card's content, not just the card, so its fields are rendered
+    try:
+        await page.wait_for_selector(f"{LISTINGS_SELECTOR} {URL_SELECTOR}", state="attached")
+    except PlaywrightTimeoutError:
+        logger.info("No listings found on the page.")
+        return []
+    logger.info("Navigated to marketplace successfully.")
+
+    # Extract the fields of all listings at once
+    listings = await page.locator(LISTINGS_SELECTOR).evaluate_all(
+        EXTRACT_LISTINGS_SCRIPT, max_listings
+    )
+    num_listings = len(listings)
+    logger.info("Found %s listings on the page.", num_listings)
+
+    # Parse
+    parsed = []
+    for i, listing_fields in enumerate(listings):
+        logger.info("Parsing listing %s/%s.", i + 1, num_listings)
+        try:
+            parsed_listing = parse_listing_fields(listing_fields)
+            parsed.append(parsed_listing)
+        except ParseError:
+            logger.warning("Failed to parse listing %s.", listing_fields)
+    logger.info("Listings parsed successfully.")
+
+    logger.info("Listings fetched successfully.")
+    return parsed
+
+
+async def scrape(
+    city: str,
+    query: str,
+    max_price: Optional[int] = None,
+    min_price: Optional[int] = None,
+    max_listings: int = 0,
+    headless: bool = True,
+) -> List[Listing]:
+    """
+    Fetches listings and their descriptions using a single browser and login.
+
+    Args:
+        city (str): The city in which to search for listings.
+        query (str): The search query or item type to look for.
+        max_price (int): The maximum price of the items to fetch.
+        min_price (int): The minimum price of the items to fetch.
+        max_listings (int): The maximum number of listings to fetch. If 0, all listings are fetched.
+        headless (bool): Whether to launch the browser in headless mode.
+
+    Returns:
+        List[Listing]: A list of Listing objects with their descriptions.
+    """
+    async with async_playwright() as pw:
         # Open browser
-        page, browser = open_browser(pw)
+        page, browser = await open_browser(pw, headless)
 
         # Login process
-        login_to_facebook(page)
-
-        # Navigate to marketplace
-        logger.info("Navigating to marketplace at %s.", marketplace_url)
-        page.goto(marketplace_url, wait_until="domcontentloaded")
-        logger.info("Navigated to marketplace successfully.")
-
-        # Highlight the listings for debugging
-        listings = page.locator(LISTINGS_SELECTOR)
-        num_listings = (
-            listings.count()
-            if not max_listings
-            else min(listings.count(), max_listings)
+        await login_if_needed(page)
+
+        listings = await fetch_marketplace_listings(
+            page, city, query, max_price, min_price, max_listings
         )
-        logger.info("Found %s listings on the page.", num_listings)
-
-        # Extract and parse
-        parsed = []
-        for i in range(num_listings):
-            logger.info("Parsing listing %s/%s.", i + 1, num_listings)
-            listing_html = listings.nth(i).inner_html()
-            try:
-                parsed_listing = parse_listing_with_soup(listing_html)
-                parsed.append(parsed_listing)
-            except ParseError:
-                logger.warning("Failed to parse listing %s.", listing_html)
-        logger.info("Listings parsed successfully.")
+        await get_descriptions(page, listings)
 
         # Close the browser
-        browser.close()
+        await browser.close()
         logger.info("Browser closed successfully.")
 
-    logger.info("Listings fetched successfully.")
-    return parsed
+    return listings
 
 
-def parse_listing_with_soup(html_content: str) -> Listing:
+def parse_listing_fields(fields: Dict[str, Optional[str]]) -> Listing:
     """
-    Parses a single listing's HTML content using BeautifulSoup.
+    Parses the raw fields extracted from a single listing in the page.
 
     Args:
-        html_content (str): The HTML content of a listing.
+        fields (Dict[str, Optional[str]]): The image, title, price, url and location of a listing.
 
     Returns:
         Listing: A dataclass representing the parsed listing.
@@ -288,43 +441,22 @@ def parse_listing_with_soup(html_content: str) -> Listing:
     Raises:
         ParseError: If the listing cannot be parsed.
     """
-    # Selectors
-    IMAGE_SELECTOR = "img.xt7dq6l.xl1xv1r.x6ikm8r.x10wlt62.xh8yej3"
-    TITLE_SELECTOR = "span.x1lliihq.x6ikm8r.x10wlt62.x1n2onr6"
-    PRICE_SELECTOR = "span.x193iq5w"
-    URL_SELECTOR = "a.x1i10hfl"
-    LOCATION_SELECTOR = "span.x1lliihq.x6ikm8r.x10wlt62.x1n2onr6.xlyipyv.xuxw1ft"
-
-    soup = BeautifulSoup(html_content, "html.parser")
-    logger.debug("Parsing listing with BeautifulSoup: %s", soup)
-
-    image_locator = soup.select_one(IMAGE_SELECTOR)
-    image = image_locator.get("src", None) if image_locator else None
-    if isinstance(image, list):
-        logger.debug("Multiple images found. Selecting the first one.")
-        image = image[0]
-    image = image[0] if isinstance(image, list) else image
+    logger.debug("Parsing listing fields: %s", fields)
+
+    image = fields["image"]
     logger.debug("Image: %s", image)
 
-    title_locator = soup.select_one(TITLE_SELECTOR)
-    title = title_locator.text.strip() if title_locator else None
+    title = fields["title"].strip() if fields["title"] else None
     logger.debug("Title: %s", title)
 
-    price_locator = soup.select_one(PRICE_SELECTOR)
-    price = price_locator.text.strip() if price_locator else None
+    price = fields["price"].strip() if fields["price"] else None
     price = convert_price_to_int(price) if price else None
     logger.debug("Price: %s", price)
 
-    link_locator = soup.select_one(URL_SELECTOR)
-    link = link_locator.get("href", None) if link_locator else None
-    if isinstance(link, list):
-        logger.debug("Multiple links found. Selecting the first one.")
-        link = link[0]
-    link = clean_listing_url(link) if link else None
+    link = clean_listing_url(fields["url"]) if fields["url"] else None
     logger.debug("Link: %s", link)
 
-    location_locator = soup.select_one(LOCATION_SELECTOR)
-    location = location_locator.text.strip() if location_locator else None
+    location = fields["location"].strip() if fields["location"] else None
     logger.debug("Location: %s", location)
 
     if not all([image, title, price, link, location]):
@@ -333,29 +465,28 @@ def parse_listing_with_soup(html_content: str) -> Listing:
     return Listing(image, title, price, link, location)  # type: ignore
 
 
-def listings_to_json(listings: List[Listing]) -> str:
+def listings_to_json(listings: List[Listing]) -> bytes:
     """
-    Converts a list of Listing objects to a JSON string.
+    Converts a list of Listing objects to UTF-8 encoded JSON.
 
     Args:
         listings (List[Listing]): The list of Listing objects to convert.
 
     Returns:
-        str: The JSON string representing the listings.
+        bytes: The JSON representing the listings.
     """
-    return json.dumps([listing.__dict__ for listing in listings], indent=4)
+    return orjson.dumps(listings, option=orjson.OPT_INDENT_2)
 
 
 if __name__ == "__main__":
     logger.setLevel(logging.INFO)
     logger.info("Fetching listings.")
-    scraped_listings = fetch_marketplace_listings(
-        "toronto", "mountain bike", max_listings=15, max_price=500
+    scraped_listings = asyncio.run(
+        scrape("toronto", "mountain bike", max_listings=15, max_price=500)
     )
-    get_descriptions(scraped_listings)
 
     logger.info("Listings fetched successfully.")
     # Save listings to JSON file
-    with open("mtb_bikes.json", "w", encoding="utf-8") as f:
+    with open("mtb_bikes.json", "wb") as f:
         f.write(listings_to_json(scraped_listings))
         logger.info("Listings saved to listings.json.")